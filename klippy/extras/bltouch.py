@@ -3,7 +3,7 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math, logging
+import logging
 import homing, probe
 
 SIGNAL_PERIOD = 0.025600
@@ -11,13 +11,16 @@ MIN_CMD_TIME = 4 * SIGNAL_PERIOD
 
 TEST_TIME = 5 * 60.
 ENDSTOP_REST_TIME = .001
-ENDSTOP_SAMPLE_TIME = .000015
 ENDSTOP_SAMPLE_COUNT = 4
+VERIFY_REST_TIME = .010
+VERIFY_SAMPLE_TIME = .0001
+SENSOR_LOG_TIME = 1.
 
 Commands = {
     None: 0.0, 'pin_down': 0.000700, 'touch_mode': 0.001200,
     'pin_up': 0.001500, 'self_test': 0.001800, 'reset': 0.002200,
 }
+CommandDuty = {cmd: pulse / SIGNAL_PERIOD for cmd, pulse in Commands.items()}
 
 # BLTouch "endstop" wrapper
 class BLTouchEndstopWrapper:
@@ -29,23 +32,42 @@ class BLTouchEndstopWrapper:
         self.mcu_pwm = ppins.setup_pin('pwm', config.get('control_pin'))
         self.mcu_pwm.setup_max_duration(0.)
         self.mcu_pwm.setup_cycle_time(SIGNAL_PERIOD)
+        self._mcu = self.mcu_pwm.get_mcu()
+        self._mcu.register_config_callback(self._build_cmd_ticks)
         # Create an "endstop" object to handle the sensor pin
         pin = config.get('sensor_pin')
         pin_params = ppins.lookup_pin(pin, can_invert=True, can_pullup=True)
         mcu = pin_params['chip']
         mcu.register_config_callback(self._build_config)
         self.mcu_endstop = mcu.setup_pin('endstop', pin_params)
+        self._steppers = ()
+        self._z_get_pos = []
+        self.next_cmd_time = 0.
+        # Optionally log sensor pin transitions (for debugging)
+        self.sensor_events = []
+        if config.getboolean('debug_log_sensor', False):
+            ppins.reset_pin_sharing(pin_params)
+            buttons = self.printer.try_load_module(config, 'buttons')
+            buttons.register_buttons([pin], self.sensor_debug_callback)
+            self.sensor_log_timer = self.printer.get_reactor().register_timer(
+                self.flush_sensor_log)
         # Setup for sensor test
-        self.next_test_time = 0.
+        self.sensor_tested = self.probe_triggered = False
+        self.start_mcu_pos = []
+        self.last_successful_probe_time = 0.
         self.test_sensor_pin = config.getboolean('test_sensor_pin', True)
+        # Setup for high-speed (pin stays deployed) multi-point probing
+        self.hs_mode = config.getboolean('hs_mode', False)
+        self.hs_active = False
+        self.pin_deployed = False
         # Calculate pin move time
-        pmt = max(config.getfloat('pin_move_time', 0.200), MIN_CMD_TIME)
-        self.pin_move_time = math.ceil(pmt / SIGNAL_PERIOD) * SIGNAL_PERIOD
+        self.pin_move_time = max(config.getfloat('pin_move_time', 0.200),
+                                 MIN_CMD_TIME)
+        self.min_cmd_ticks = self.pin_move_ticks = 0
         # Wrappers
         self.get_mcu = self.mcu_endstop.get_mcu
         self.add_stepper = self.mcu_endstop.add_stepper
         self.get_steppers = self.mcu_endstop.get_steppers
-        self.home_wait = self.mcu_endstop.home_wait
         self.query_endstop = self.mcu_endstop.query_endstop
         self.query_endstop_wait = self.mcu_endstop.query_endstop_wait
         self.TimeoutError = self.mcu_endstop.TimeoutError
@@ -57,50 +79,133 @@ class BLTouchEndstopWrapper:
         kin = self.printer.lookup_object('toolhead').get_kinematics()
         for stepper in kin.get_steppers('Z'):
             stepper.add_to_endstop(self)
-    def send_cmd(self, print_time, cmd):
-        self.mcu_pwm.set_pwm(print_time, Commands[cmd] / SIGNAL_PERIOD)
-    def test_sensor(self):
-        if not self.test_sensor_pin:
-            return
+        self._steppers = tuple(self.mcu_endstop.get_steppers())
+        self._z_get_pos = [s.get_mcu_position for s in self._steppers]
+    def _build_cmd_ticks(self):
+        # Round the pin move time up to a whole number of signal periods
+        mcu = self._mcu
+        period_ticks = mcu.seconds_to_clock(SIGNAL_PERIOD)
+        pmt_ticks = mcu.seconds_to_clock(self.pin_move_time)
+        self.pin_move_ticks = -(-pmt_ticks // period_ticks) * period_ticks
+        self.pin_move_time = (mcu.clock_to_print_time(self.pin_move_ticks)
+                              - mcu.clock_to_print_time(0))
+        self.min_cmd_ticks = mcu.seconds_to_clock(MIN_CMD_TIME)
+    def sensor_debug_callback(self, eventtime, state):
+        if not self.sensor_events:
+            reactor = self.printer.get_reactor()
+            reactor.update_timer(self.sensor_log_timer,
+                                 eventtime + SENSOR_LOG_TIME)
+        self.sensor_events.append((eventtime, state))
+    def flush_sensor_log(self, eventtime):
+        events, self.sensor_events = self.sensor_events, []
+        if not logging.getLogger().isEnabledFor(logging.INFO):
+            return self.printer.get_reactor().NEVER
+        logging.info("bltouch sensor events: %s", " ".join(
+            ["%.3f:%d" % (etime, state) for etime, state in events]))
+        return self.printer.get_reactor().NEVER
+    def sync_print_time(self):
         toolhead = self.printer.lookup_object('toolhead')
         print_time = toolhead.get_last_move_time()
-        if print_time < self.next_test_time:
-            self.next_test_time = print_time + TEST_TIME
-            return
-        # Raise the bltouch probe and test if probe is raised
-        self.send_cmd(print_time, 'reset')
-        home_time = print_time + self.pin_move_time
-        self.send_cmd(home_time, 'touch_mode')
-        self.send_cmd(home_time + MIN_CMD_TIME, None)
+        if self.next_cmd_time > print_time:
+            toolhead.dwell(self.next_cmd_time - print_time)
+        else:
+            self.next_cmd_time = print_time
+    def _batch_cmds(self, seq):
+        # Schedule a series of (cmd, duration_ticks) pairs back-to-back.
+        # Returns the start time of each command and the batch end time.
+        mcu = self._mcu
+        cmd_clock = mcu.print_time_to_clock(self.next_cmd_time)
+        cmd_times = []
+        for cmd, duration_ticks in seq:
+            cmd_time = mcu.clock_to_print_time(cmd_clock)
+            self.mcu_pwm.set_pwm(cmd_time, CommandDuty[cmd])
+            cmd_times.append(cmd_time)
+            cmd_clock += duration_ticks
+        self.next_cmd_time = mcu.clock_to_print_time(cmd_clock)
+        cmd_times.append(self.next_cmd_time)
+        return cmd_times
+    def verify_state(self, check_start_time, check_end_time,
+                     sample_count=ENDSTOP_SAMPLE_COUNT):
         # Perform endstop check to verify bltouch reports probe raised
-        prev_positions = [s.get_commanded_position()
-                          for s in self.mcu_endstop.get_steppers()]
-        self.mcu_endstop.home_start(home_time, ENDSTOP_SAMPLE_TIME,
-                                    ENDSTOP_SAMPLE_COUNT, ENDSTOP_REST_TIME)
+        steppers = self._steppers
+        prev_positions = [s.get_commanded_position() for s in steppers]
+        self.mcu_endstop.home_start(check_start_time, VERIFY_SAMPLE_TIME,
+                                    sample_count, VERIFY_REST_TIME)
         try:
-            self.mcu_endstop.home_wait(home_time + MIN_CMD_TIME)
+            self.mcu_endstop.home_wait(check_end_time)
         except self.mcu_endstop.TimeoutError as e:
             raise homing.EndstopError("BLTouch sensor test failed")
-        for s, pos in zip(self.mcu_endstop.get_steppers(), prev_positions):
+        for s, pos in zip(steppers, prev_positions):
             s.set_commanded_position(pos)
-        # Test was successful
-        self.next_test_time = home_time + TEST_TIME
-        toolhead.reset_print_time(home_time + 2. * MIN_CMD_TIME)
-    def home_prepare(self):
-        self.test_sensor()
+    def test_sensor(self):
+        if not self.test_sensor_pin:
+            return
         toolhead = self.printer.lookup_object('toolhead')
         print_time = toolhead.get_last_move_time()
-        self.send_cmd(print_time, 'pin_down')
-        self.send_cmd(print_time + self.pin_move_time, 'touch_mode')
-        toolhead.dwell(self.pin_move_time + MIN_CMD_TIME)
+        if (self.sensor_tested
+            and print_time - self.last_successful_probe_time < TEST_TIME):
+            # A recent successful probe already proved the sensor works
+            return
+        # Raise the bltouch probe and test if probe is raised
+        self.sync_print_time()
+        cmd_times = self._batch_cmds([
+            ('reset', self.pin_move_ticks), ('touch_mode', self.min_cmd_ticks),
+            (None, self.min_cmd_ticks)])
+        # Check the sensor while in touch_mode
+        check_start_time, check_end_time = cmd_times[1], cmd_times[2]
+        sample_count = ENDSTOP_SAMPLE_COUNT
+        if self.sensor_tested:
+            # A single sample suffices to confirm the steady raised signal
+            sample_count = 1
+        self.verify_state(check_start_time, check_end_time, sample_count)
+        # Test was successful
+        self.sensor_tested = True
+        self.last_successful_probe_time = cmd_times[-1]
+        toolhead.reset_print_time(cmd_times[-1])
+    def raise_probe(self):
+        self.sync_print_time()
+        self._batch_cmds([('reset', self.min_cmd_ticks),
+                          ('pin_up', self.pin_move_ticks)])
+        self.sync_print_time()
+        # The toolhead need not wait for the trailing idle signal
+        self._batch_cmds([(None, self.min_cmd_ticks)])
+        self.pin_deployed = False
+    def set_hs_mode(self, active):
+        # Called by the probe code around a series of probe attempts
+        if not self.hs_mode:
+            return
+        self.hs_active = active
+        if not active and self.pin_deployed:
+            self.raise_probe()
+    def home_prepare(self):
+        self.probe_triggered = False
+        if self.hs_active and self.pin_deployed:
+            # Pin is still down from the previous probe - just rearm it
+            self.sync_print_time()
+            self._batch_cmds([('touch_mode', self.min_cmd_ticks)])
+            self.sync_print_time()
+        else:
+            self.test_sensor()
+            # Sync with the toolhead (not just the mcu clock) so that the
+            # pin is not lowered while queued moves are still running
+            self.sync_print_time()
+            self._batch_cmds([('pin_down', self.pin_move_ticks),
+                              ('touch_mode', self.min_cmd_ticks)])
+            self.sync_print_time()
+            self.pin_deployed = True
+        self.start_mcu_pos = [get_pos() for get_pos in self._z_get_pos]
         self.mcu_endstop.home_prepare()
+    def home_wait(self, home_end_time):
+        self.mcu_endstop.home_wait(home_end_time)
+        self.probe_triggered = True
     def home_finalize(self):
-        toolhead = self.printer.lookup_object('toolhead')
-        print_time = toolhead.get_last_move_time()
-        self.send_cmd(print_time, 'reset')
-        self.send_cmd(print_time + MIN_CMD_TIME, 'pin_up')
-        self.send_cmd(print_time + MIN_CMD_TIME + self.pin_move_time, None)
-        toolhead.dwell(self.pin_move_time + MIN_CMD_TIME)
+        if not self.hs_active:
+            self.raise_probe()
+        # Only a probe that triggered after movement proves the sensor works
+        moved = [get_pos() != pos
+                 for get_pos, pos in zip(self._z_get_pos, self.start_mcu_pos)]
+        if self.probe_triggered and all(moved):
+            self.last_successful_probe_time = self.next_cmd_time
         self.mcu_endstop.home_finalize()
     def home_start(self, print_time, sample_time, sample_count, rest_time):
         rest_time = min(rest_time, ENDSTOP_REST_TIME)
@@ -115,14 +220,13 @@ class BLTouchEndstopWrapper:
             self.gcode.respond_info("BLTouch commands: %s" % (
                 ", ".join(sorted([c for c in Commands if c is not None]))))
             return
-        toolhead = self.printer.lookup_object('toolhead')
-        print_time = toolhead.get_last_move_time()
         msg = "Sending BLTOUCH_DEBUG COMMAND=%s" % (cmd,)
         self.gcode.respond_info(msg)
         logging.info(msg)
-        self.send_cmd(print_time, cmd)
-        self.send_cmd(print_time + self.pin_move_time, None)
-        toolhead.dwell(self.pin_move_time + MIN_CMD_TIME)
+        self.sync_print_time()
+        self._batch_cmds([(cmd, self.pin_move_ticks),
+                          (None, self.min_cmd_ticks)])
+        self.sync_print_time()
 
 def load_config(config):
     blt = BLTouchEndstopWrapper(config)
@@ -3,6 +3,7 @@
 # Copyright (C) 2017-2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
+import logging
 import pins, homing
 
 HINT_TIMEOUT = """
@@ -43,6 +44,8 @@ class PrinterProbe:
         return self.mcu_probe
     def get_offsets(self):
         return self.x_offset, self.y_offset, self.z_offset
+    def set_hs_mode(self, active):
+        self.mcu_probe.set_hs_mode(active)
     cmd_PROBE_help = "Probe Z-height at current XY position"
     def cmd_PROBE(self, params):
         toolhead = self.printer.lookup_object('toolhead')
@@ -108,6 +111,8 @@ class ProbeEndstopWrapper:
             gcode = self.printer.lookup_object('gcode')
             gcode.run_script_from_command(self.deactivate_gcode)
         self.mcu_endstop.home_finalize()
+    def set_hs_mode(self, active):
+        pass
     def get_position_endstop(self):
         return self.position_endstop
 
@@ -140,7 +145,7 @@ class ProbePointsHelper:
         # Internal probing state
         self.results = []
         self.busy = False
-        self.gcode = self.toolhead = None
+        self.gcode = self.toolhead = self.probe = None
     def get_lift_speed(self):
         return self.lift_speed
     def _lift_z(self, z_pos, add=False, speed=None):
@@ -209,6 +214,7 @@ class ProbePointsHelper:
             self.lift_speed = self.speed
             self.probe_offsets = (0., 0., 0.)
         # Start probe
+        self.probe = probe
         self.results = []
         self.busy = True
         self._lift_z(self.horizontal_move_z, speed=self.speed)
@@ -220,9 +226,14 @@ class ProbePointsHelper:
                                         desc=self.cmd_NEXT_help)
         else:
             # Perform automatic probing
-            while self.busy:
-                self._automatic_probe_point()
-                self._move_next()
+            probe.set_hs_mode(True)
+            try:
+                while self.busy:
+                    self._automatic_probe_point()
+                    self._move_next()
+            finally:
+                # Fallback for errors not routed through _finalize()
+                self._end_hs_mode(False)
     cmd_NEXT_help = "Move to the next XY position to probe"
     def cmd_NEXT(self, params):
         # Record current position for manual probe
@@ -230,10 +241,23 @@ class ProbePointsHelper:
         self.results.append(self.toolhead.get_kinematics().calc_position())
         # Move to next position
         self._move_next()
+    def _end_hs_mode(self, success):
+        probe, self.probe = self.probe, None
+        if probe is None:
+            return
+        if success:
+            probe.set_hs_mode(False)
+            return
+        # Don't let a failure to raise the probe hide the original error
+        try:
+            probe.set_hs_mode(False)
+        except:
+            logging.exception("Unable to raise probe after probing error")
     def _finalize(self, success):
         self.busy = False
         self.gcode.reset_last_position()
         self.gcode.register_command('NEXT', None)
+        self._end_hs_mode(success)
         if success:
             self.finalize_callback(self.probe_offsets, self.results)
 